@@ -43,19 +43,27 @@ Based very heavily on code released under the following terms:
 """
 
 
+import time
+startTime = time.time()
+
 import sys
 import os
+import copy
+import marshal
+import re
+import heapq
+from array import array
+from collections import OrderedDict
 from optparse import OptionParser
 import logging as l
-l.basicConfig(level=l.DEBUG, format="%(message)s")
-
-from osgeo import ogr
-from osgeo import osr
 
 from SimpleXMLWriter import XMLWriter
 
 # Setup program usage
-usage = "usage: %prog SRCFILE"
+usage = "usage: %prog SRCFILE [SRCFILE ...]\n\n" + \
+        "Several source files are converted into one output file, with " + \
+        "nodes shared\nbetween them. A SRCFILE may be a glob pattern, or " + \
+        "@LISTFILE to read the\nsource filenames from LISTFILE, one per line."
 parser = OptionParser(usage=usage)
 parser.add_option("-t", "--translation", dest="translationMethod",
                   metavar="TRANSLATION",
@@ -70,44 +78,201 @@ parser.add_option("-e", "--epsg", dest="sourceEPSG", metavar="EPSG_CODE",
 parser.add_option("-p", "--proj4", dest="sourcePROJ4", metavar="PROJ4_STRING",
                   help="PROJ.4 string. If specified, overrides projection " +
                        "from source metadata if it exists.")
-parser.add_option("-v", "--verbose", dest="verbose", action="store_true")
+parser.add_option("-v", "--verbose", dest="verbose", action="store_true",
+                  help="Show debug messages.")
 parser.add_option("-d", "--debug-tags", dest="debugTags", action="store_true",
                   help="Output the tags for every feature parsed.")
 parser.add_option("-f", "--force", dest="forceOverwrite", action="store_true",
                   help="Force overwrite of output file.")
+parser.add_option("--sort-ids", dest="sortIds", action="store_true",
+                  help="Renumber elements after merging so that node IDs " +
+                       "follow a Hilbert curve over the node coordinates " +
+                       "and ways and relations are numbered in the order " +
+                       "of their first member. Elements are written in ID " +
+                       "order.")
+parser.add_option("--id-offset", dest="idOffset", metavar="OFFSET",
+                  help="Renumber with positive IDs starting after OFFSET, " +
+                       "e.g. to merge with existing data. Implies " +
+                       "--sort-ids.")
+
+parser.add_option("--simplify", dest="simplifyTolerance", metavar="TOLERANCE",
+                  type="float",
+                  help="Simplify ways before merging nodes, dropping " +
+                       "vertices closer than TOLERANCE (in degrees) to the " +
+                       "simplified line. Vertices shared between ways are " +
+                       "always kept, and removed vertices are put back " +
+                       "where a simplified way would cross itself or " +
+                       "another way.")
+parser.add_option("--max-way-nodes", dest="maxWayNodes", metavar="NODES",
+                  type="int",
+                  help="Split ways with more than NODES nodes into chained " +
+                       "ways. Split polygon rings become multipolygon " +
+                       "relation members. OSM allows at most 2000.")
+parser.add_option("--memory-limit", dest="memoryLimit", metavar="SIZE",
+                  help="Approximate memory budget for the parsed data, in " +
+                       "bytes or with a K, M, G or T suffix. Beyond it, " +
+                       "parsed data is spilled to temporary files next to " +
+                       "the output and merged from disk.")
+parser.add_option("--checkpoint-dir", dest="checkpointDir", metavar="DIR",
+                  help="Save the conversion state to DIR after each layer, " +
+                       "after merging and while writing the output, so " +
+                       "that an interrupted conversion can be resumed.")
+parser.add_option("--resume", dest="resume", action="store_true",
+                  help="Resume an interrupted conversion from the state " +
+                       "saved in --checkpoint-dir.")
+parser.add_option("--shared-boundaries", dest="sharedBoundaries",
+                  action="store_true",
+                  help="Write boundaries shared by adjacent polygons once, " +
+                       "as ways referenced by multipolygon relations, " +
+                       "instead of once for every polygon.")
+parser.add_option("--split-by", dest="splitBy", metavar="SPLIT",
+                  help="Write several self-contained output files instead " +
+                       "of one: one per source layer with 'layer', one per " +
+                       "value of the tag KEY with 'attribute:KEY', or with " +
+                       "at most N features each with 'count:N'. A manifest " +
+                       "lists the files with their element counts and ID " +
+                       "ranges.")
+parser.add_option("--progress", dest="progress", action="store_true",
+                  help="Report progress, throughput, ETA and memory use " +
+                       "on stderr every few seconds.")
+parser.add_option("--status-file", dest="statusFile", metavar="FILE",
+                  help="Append progress reports to FILE as JSON lines.")
+parser.add_option("-j", "--jobs", dest="jobs", metavar="JOBS", type="int",
+                  help="Number of processes used to read source files and " +
+                       "to write the output file. The output is identical " +
+                       "for any number of processes.")
 
 parser.set_defaults(sourceEPSG=None, sourcePROJ4=None, verbose=False,
                     debugTags=False,
                     translationMethod=None, outputFile=None,
-                    forceOverwrite=False)
+                    forceOverwrite=False, sortIds=False, idOffset=None,
+                    jobs=1, simplifyTolerance=None, maxWayNodes=None,
+                    memoryLimit=None, checkpointDir=None, resume=False,
+                    sharedBoundaries=False, splitBy=None, progress=False,
+                    statusFile=None)
 
 # Parse and process arguments
 (options, args) = parser.parse_args()
 
+if options.verbose:
+    l.basicConfig(level=l.DEBUG, format="%(message)s")
+else:
+    l.basicConfig(level=l.INFO, format="%(message)s")
+
 try:
     if options.sourceEPSG:
         options.sourceEPSG = int(options.sourceEPSG)
 except:
     parser.error("EPSG code must be numeric (e.g. '4326', not 'epsg:4326')")
 
+try:
+    if options.idOffset is not None:
+        options.idOffset = int(options.idOffset)
+        options.sortIds = True
+except:
+    parser.error("ID offset must be numeric")
+if options.idOffset is not None and options.idOffset < 0:
+    parser.error("ID offset must not be negative")
+
+if options.simplifyTolerance is not None and options.simplifyTolerance < 0:
+    parser.error("simplification tolerance must not be negative")
+
+if options.maxWayNodes is not None and options.maxWayNodes < 2:
+    parser.error("ways need at least 2 nodes")
+
+def parseSize(size):
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+    size = size.strip().upper()
+    if size[-1:] == "B":
+        size = size[:-1]
+    if size[-1:] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+try:
+    if options.memoryLimit is not None:
+        options.memoryLimit = parseSize(options.memoryLimit)
+except ValueError:
+    parser.error("memory limit must be a number of bytes, optionally " +
+                 "followed by K, M, G or T (e.g. '4G')")
+
+if options.resume and not options.checkpointDir:
+    parser.error("--resume needs --checkpoint-dir")
+if options.checkpointDir and options.memoryLimit is not None:
+    parser.error("--checkpoint-dir can not be combined with --memory-limit")
+if options.checkpointDir:
+    options.checkpointDir = os.path.realpath(options.checkpointDir)
+
+if options.splitBy is not None:
+    (kind, separator, value) = options.splitBy.partition(":")
+    if kind == "layer" and not separator:
+        options.splitBy = ("layer", None)
+    elif kind == "attribute" and value:
+        options.splitBy = ("attribute", value)
+    elif kind == "count" and value.isdigit() and int(value) > 0:
+        options.splitBy = ("count", int(value))
+    else:
+        parser.error("--split-by must be 'layer', 'attribute:KEY' or 'count:N'")
+    if options.memoryLimit is not None:
+        parser.error("--split-by can not be combined with --memory-limit")
+
+if options.jobs < 1:
+    parser.error("the number of jobs must be at least 1")
+elif options.jobs > 1 and not hasattr(os, "fork"):
+    # Worker processes rely on inheriting the parsed data by forking
+    l.warning("Parallel output needs os.fork, falling back to one process")
+    options.jobs = 1
+
 if len(args) < 1:
     parser.print_help()
     parser.error("you must specify a source filename")
-elif len(args) > 1:
-    parser.error("you have specified too many arguments, " +
-                 "only supply the source filename")
+
+# Expand list files and glob patterns into the source filenames
+import glob
+sourceFiles = []
+for arg in args:
+    if arg.startswith("@"):
+        try:
+            listFile = open(arg[1:], 'r')
+        except IOError:
+            parser.error("could not read the list file '%s'" % (arg[1:]))
+        for line in listFile:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                sourceFiles.append(line)
+        listFile.close()
+    elif glob.has_magic(arg):
+        matches = sorted(glob.glob(arg))
+        if not matches:
+            parser.error("no files match '%s'" % (arg))
+        sourceFiles.extend(matches)
+    else:
+        sourceFiles.append(arg)
+sourceFiles = [os.path.realpath(sourceFile) for sourceFile in sourceFiles]
+for sourceFile in sourceFiles:
+    if not os.path.isfile(sourceFile):
+        parser.error("the file '%s' does not exist" % (sourceFile))
 
 # Input and output file
-# if no output file given, use the basename of the source but with .osm
-sourceFile = os.path.realpath(args[0])
+# if no output file given, use the basename of the first source but with .osm
 if options.outputFile is not None:
     options.outputFile = os.path.realpath(options.outputFile)
 else:
-    (base, ext) = os.path.splitext(os.path.basename(sourceFile))
+    (base, ext) = os.path.splitext(os.path.basename(sourceFiles[0]))
     options.outputFile = os.path.join(os.getcwd(), base + ".osm")
-if not options.forceOverwrite and os.path.exists(options.outputFile):
+if (not options.forceOverwrite and not options.resume and
+    not options.splitBy and os.path.exists(options.outputFile)):
     parser.error("ERROR: output file '%s' exists" % (options.outputFile))
-l.info("Preparing to convert file '%s' to '%s'." % (sourceFile, options.outputFile))
+if (not options.forceOverwrite and options.splitBy and
+    os.path.exists(os.path.splitext(options.outputFile)[0] + ".manifest.json")):
+    # The names of the parts are only known after parsing, when they are
+    # checked, but an earlier split output always has a manifest
+    parser.error("ERROR: output file '%s' exists"
+                 % (os.path.splitext(options.outputFile)[0] + ".manifest.json"))
+if len(sourceFiles) == 1:
+    l.info("Preparing to convert file '%s' to '%s'." % (sourceFiles[0], options.outputFile))
+else:
+    l.info("Preparing to convert %d files to '%s'." % (len(sourceFiles), options.outputFile))
 
 # Projection
 if not options.sourcePROJ4 and not options.sourceEPSG:
@@ -128,7 +293,7 @@ if options.translationMethod:
         # first check translations in the subdir translations of cwd
         sys.path.insert(0, os.path.join(os.getcwd(), "translations"))
         # then check subdir of script dir
-        sys.path.insert(1, os.path.join(os.path.abspath(__file__), "translations"))
+        sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), "translations"))
         # (the cwd will also be checked implicityly)
 
     # strip .py if present, as import wants just the module name
@@ -149,40 +314,29 @@ else:
     translations = types.ModuleType("translationmodule")
     l.info("Using default translations")
 
-try:
-    translations.filterLayer(None)
-    l.debug("Using user filterLayer")
-except:
-    l.debug("Using default filterLayer")
-    translations.filterLayer = lambda layer: layer
-
-try:
-    translations.filterFeature(None, None, None)
-    l.debug("Using user filterFeature")
-except:
-    l.debug("Using default filterFeature")
-    translations.filterFeature = lambda feature, fieldNames, reproject: feature
-
-try:
-    translations.filterTags(None)
-    l.debug("Using user filterTags")
-except:
-    l.debug("Using default filterTags")
-    translations.filterTags = lambda tags: tags
+# Detect the hooks the translation defines by looking them up rather than
+# calling them, so no user code runs before the conversion starts
+defaultHooks = [
+    ("filterLayer", lambda layer: layer),
+    ("filterFeature", lambda feature, fieldNames, reproject: feature),
+    ("filterTags", lambda tags: tags),
+    ("filterFeaturePost", lambda feature, fieldNames, reproject: feature),
+    ("preOutputTransform", lambda geometries, features: None)]
+userHooks = []
+for (hookName, defaultHook) in defaultHooks:
+    if callable(getattr(translations, hookName, None)):
+        l.debug("Using user " + hookName)
+        userHooks.append(hookName)
+    else:
+        l.debug("Using default " + hookName)
+        setattr(translations, hookName, defaultHook)
 
-try:
-    translations.filterFeaturePost(None, None, None)
-    l.debug("Using user filterFeaturePost")
-except:
-    l.debug("Using default filterFeaturePost")
-    translations.filterFeaturePost = lambda feature, fieldNames, reproject: feature
+# GDAL is slow to import, so only load it once the arguments are known to be
+# good
+from osgeo import ogr
+from osgeo import osr
 
-try:
-    translations.preOutputTransform(None, None)
-    l.debug("Using user preOutputTransform")
-except:
-    l.debug("Using default preOutputTransform")
-    translations.preOutputTransform = lambda geometries, features: None
+l.debug("Startup took %.3f seconds" % (time.time() - startTime))
 
 # Done options parsing, now to program code
 
@@ -190,6 +344,32 @@ except:
 geometries = []
 features = []
 
+# Number of elements rendered together when writing the output
+OUTPUT_CHUNK_SIZE = 50000
+
+OSM_HEADER = '<osm generator="uvmogr2osm" version="0.6">'
+OSM_FOOTER = '</osm>'
+
+# Rough size in bytes of a parsed geometry and feature, used to check the
+# parsed data against --memory-limit
+GEOMETRY_SIZE = 600
+FEATURE_SIZE = 1000
+
+# Number of records stored together in a run file
+RUN_CHUNK_SIZE = 65536
+
+# Runs of parsed data spilled to disk when over the memory limit
+spillDirectory = None
+spillRuns = []
+
+# Seconds between progress reports, and number of items between checks of
+# the clock
+PROGRESS_INTERVAL = 5.0
+PROGRESS_CHECK = 1000
+
+# Number of layers parsed so far, over all the sources
+parsedLayers = 0
+
 # Helper function to get a new ID
 elementIdCounter = 0
 def getNewID():
@@ -216,7 +396,10 @@ class Geometry(object):
             geometries.remove(self)
 
 class Point(Geometry):
+    # Number of points created, for progress reports
+    created = 0
     def __init__(self, x, y):
+        Point.created += 1
         Geometry.__init__(self)
         self.x = x
         self.y = y
@@ -224,6 +407,8 @@ class Point(Geometry):
         pass
 
 class Way(Geometry):
+    # True for the rings of polygons
+    ring = False
     def __init__(self):
         Geometry.__init__(self)
         self.points = []
@@ -233,6 +418,9 @@ class Way(Geometry):
         i.addparent(self)
 
 class Relation(Geometry):
+    # True for relations standing in for a polygon that would otherwise be a
+    # closed way, whose feature needs type=multipolygon to stay an area
+    multipolygon = False
     def __init__(self):
         Geometry.__init__(self)
         self.members = []
@@ -244,6 +432,7 @@ class Relation(Geometry):
 class Feature(object):
     geometry = None
     tags = {}
+    layer = None
     def __init__(self):
         global features
         features.append(self)
@@ -253,6 +442,94 @@ class Feature(object):
         j.removeparent(self)
         i.addparent(self)
 
+class Progress(object):
+    # Reports the progress of a loop, which calls tick() for every item or
+    # batch of items. tick() only looks at the clock every PROGRESS_CHECK
+    # items, and never when reporting is turned off.
+    statusFile = None
+    def __init__(self, stage, total=None, unit="features"):
+        self.stage = stage
+        self.total = total
+        self.unit = unit
+        self.count = 0
+        self.start = self.last = time.time()
+        self.lastCount = 0
+        self.startPoints = self.lastPoints = Point.created
+        if options.progress or options.statusFile:
+            self.next = PROGRESS_CHECK
+        else:
+            self.next = float("inf")
+    def tick(self, count=1):
+        self.count += count
+        if self.count >= self.next:
+            self.next = self.count + PROGRESS_CHECK
+            if time.time() - self.last >= PROGRESS_INTERVAL:
+                self.report()
+    def finish(self):
+        if options.progress or options.statusFile:
+            self.report(done=True)
+    def report(self, done=False):
+        now = time.time()
+        elapsed = (now - self.last) or 1e-9
+        rate = (self.count - self.lastCount) / elapsed
+        pointRate = (Point.created - self.lastPoints) / elapsed
+        if done:
+            # Report averages over the whole stage at the end
+            elapsed = (now - self.start) or 1e-9
+            rate = self.count / elapsed
+            pointRate = (Point.created - self.startPoints) / elapsed
+        eta = None
+        if self.total and self.count and not done:
+            eta = (self.total - self.count) * (now - self.start) / self.count
+        rss = getRSS()
+        (self.last, self.lastCount, self.lastPoints) = (now, self.count, Point.created)
+
+        if options.progress:
+            message = "%s: %d" % (self.stage, self.count)
+            if self.total:
+                message += "/%d %s (%d%%)" % (self.total, self.unit,
+                                             100 * self.count / self.total)
+            else:
+                message += " " + self.unit
+            message += ", %d %s/s" % (rate, self.unit)
+            if pointRate:
+                message += ", %d vertices/s" % pointRate
+            if eta is not None:
+                message += ", ETA %d:%02d:%02d" % (eta / 3600, eta / 60 % 60, eta % 60)
+            if rss:
+                message += ", RSS %.1f MB" % (rss / 1048576.0)
+            if done:
+                message += ", done in %.1fs" % (now - self.start)
+            sys.stderr.write(message + "\n")
+        if options.statusFile:
+            if Progress.statusFile is None:
+                Progress.statusFile = open(options.statusFile, 'a')
+            import json
+            json.dump({"time": now, "stage": self.stage, "unit": self.unit,
+                       "count": self.count, "total": self.total,
+                       "rate": rate, "vertexRate": pointRate, "eta": eta,
+                       "rss": rss, "done": done}, Progress.statusFile)
+            Progress.statusFile.write("\n")
+            Progress.statusFile.flush()
+
+def getRSS():
+    # Current resident set size in bytes where /proc is available, else the
+    # peak size
+    try:
+        f = open("/proc/self/statm", 'r')
+        pages = int(f.read().split()[1])
+        f.close()
+        return pages * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+        # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+        scale = 1 if sys.platform == "darwin" else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    except ImportError:
+        return None
+
 def getFileData(filename):
     if not os.path.isfile(filename):
         parser.error("the file '%s' does not exist" % (filename))
@@ -262,13 +539,79 @@ def getFileData(filename):
         sys.exit(1)
     return dataSource
 
+def parseSources(sourceFiles):
+    global elementIdCounter
+    if checkpoint["layers"]:
+        l.info("Loading %d parsed layers from checkpoint" % checkpoint["layers"])
+        for i in range(checkpoint["layers"]):
+            loadRun(os.path.join(options.checkpointDir, "layer%d" % i))
+        elementIdCounter = checkpoint["idCounter"]
+
+    # Sources can be read in parallel when nothing depends on the order or
+    # process they are read in
+    concurrent = (options.jobs > 1 and len(sourceFiles) > 1 and
+                  options.memoryLimit is None and not options.checkpointDir and
+                  "filterFeaturePost" not in userHooks and
+                  "preOutputTransform" not in userHooks)
+    if concurrent:
+        l.debug("Reading %d sources with %d processes" % (len(sourceFiles), options.jobs))
+        import multiprocessing
+        pool = multiprocessing.Pool(options.jobs)
+        for (runFile, idCount) in pool.imap(parseSource, sourceFiles):
+            # Each worker numbers its geometries from 0, so shifting them by
+            # the IDs used so far gives the numbering of a serial read
+            idShift = elementIdCounter
+            loadRun(runFile, idShift)
+            elementIdCounter = idShift + idCount
+            removeRun(runFile)
+        pool.close()
+        pool.join()
+    else:
+        for sourceFile in sourceFiles:
+            parseData(getFileData(sourceFile))
+
+def parseSource(sourceFile):
+    # Runs in a worker process and hands the parsed source back in a run
+    # file. getFileData exits on failure, which would leave the pool
+    # waiting for this worker.
+    global geometries, features, elementIdCounter
+    geometries = []
+    features = []
+    elementIdCounter = 0
+    try:
+        dataSource = getFileData(sourceFile)
+    except SystemExit:
+        raise Exception("could not read '%s'" % sourceFile)
+    parseData(dataSource)
+    import tempfile
+    (fd, runFile) = tempfile.mkstemp(prefix="ogr2osm-",
+                                     dir=os.path.dirname(options.outputFile))
+    os.close(fd)
+    os.remove(runFile)
+    writeRun(runFile, geometries, features)
+    return (runFile, elementIdCounter)
+
 def parseData(dataSource):
     l.debug("Parsing data")
-    global translations
+    global translations, parsedLayers
     for i in range(dataSource.GetLayerCount()):
+        # Layers loaded from the checkpoint are skipped
+        if parsedLayers < checkpoint["layers"]:
+            parsedLayers += 1
+            continue
+        geometryStart = len(geometries)
+        featureStart = len(features)
         layer = dataSource.GetLayer(i)
         layer.ResetReading()
         parseLayer(translations.filterLayer(layer))
+        if options.checkpointDir:
+            # Parsing a layer only adds geometries, which don't refer to
+            # those of other layers until points are merged
+            writeRun(os.path.join(options.checkpointDir, "layer%d" % parsedLayers),
+                     geometries[geometryStart:], features[featureStart:])
+        parsedLayers += 1
+        if options.checkpointDir:
+            writeCheckpoint("parse", layers=parsedLayers)
 
 def getTransform(layer):
     global options
@@ -323,11 +666,20 @@ def parseLayer(layer):
     fieldNames = getLayerFields(layer)
     reproject = getTransform(layer)
     
-    for j in range(layer.GetFeatureCount()):
+    layerName = layer.GetName()
+    featureCount = layer.GetFeatureCount()
+    progress = Progress("parse %s" % layerName, featureCount)
+    
+    for j in range(featureCount):
         ogrfeature = layer.GetNextFeature()
-        parseFeature(translations.filterFeature(ogrfeature, fieldNames, reproject), fieldNames, reproject)
-
-def parseFeature(ogrfeature, fieldNames, reproject):
+        parseFeature(translations.filterFeature(ogrfeature, fieldNames, reproject), fieldNames, reproject, layerName)
+        progress.tick()
+        if (options.memoryLimit is not None and
+            len(geometries) * GEOMETRY_SIZE + len(features) * FEATURE_SIZE > options.memoryLimit):
+            spillRun()
+    progress.finish()
+
+def parseFeature(ogrfeature, fieldNames, reproject, layerName=None):
     if ogrfeature is None:
         return
 
@@ -339,14 +691,33 @@ def parseFeature(ogrfeature, fieldNames, reproject):
     if geometry is None:
         return
 
-    feature = Feature()
-    feature.tags = getFeatureTags(ogrfeature, fieldNames)
-    feature.geometry = geometry
-    geometry.addparent(feature)
-
-    translations.filterFeaturePost(feature, ogrfeature, ogrgeometry)
+    # A line split by --max-way-nodes comes back as a list of ways, each of
+    # which becomes a feature with its own copy of the tags
+    if type(geometry) == list:
+        pieces = geometry
+    else:
+        pieces = [geometry]
+    tags = getFeatureTags(ogrfeature, fieldNames)
+    for geometry in pieces:
+        feature = Feature()
+        if len(pieces) == 1:
+            feature.tags = tags
+        else:
+            feature.tags = copy.copy(tags)
+        feature.layer = layerName
+        feature.geometry = geometry
+        geometry.addparent(feature)
+        if type(geometry) == Relation and geometry.multipolygon:
+            setMultipolygonType(feature)
+
+        translations.filterFeaturePost(feature, ogrfeature, ogrgeometry)
     
 
+def setMultipolygonType(feature):
+    # The tags may be shared with the translation, so change a copy
+    feature.tags = copy.copy(feature.tags)
+    feature.tags["type"] = "multipolygon"
+
 def parseGeometry(ogrgeometry):
     geometryType = ogrgeometry.GetGeometryType()
 
@@ -357,7 +728,10 @@ def parseGeometry(ogrgeometry):
           geometryType == ogr.wkbLinearRing or
           geometryType == ogr.wkbLineString25D):
 #         geometryType == ogr.wkbLinearRing25D does not exist
-        return parseLineString(ogrgeometry)
+        ways = splitWay(parseLineString(ogrgeometry))
+        if len(ways) == 1:
+            return ways[0]
+        return ways
     elif (geometryType == ogr.wkbPolygon or
           geometryType == ogr.wkbPolygon25D):
         return parsePolygon(ogrgeometry)
@@ -391,26 +765,60 @@ def parseLineString(ogrgeometry):
         mypoint.addparent(geometry)
     return geometry
 
+def splitWay(way):
+    # Splits ways longer than --max-way-nodes into a chain of ways, each
+    # sharing its last point with the first point of the next one
+    limit = options.maxWayNodes
+    if limit is None or len(way.points) <= limit:
+        return [way]
+    points = way.points
+    way.points = points[:limit]
+    for point in points[limit:]:
+        point.removeparent(way, False)
+    ways = [way]
+    for start in range(limit - 1, len(points) - 1, limit - 1):
+        piece = Way()
+        piece.points = points[start:start + limit]
+        for point in piece.points:
+            point.addparent(piece)
+        ways.append(piece)
+    return ways
+
+def parseRing(ogrgeometry):
+    ways = splitWay(parseLineString(ogrgeometry))
+    for way in ways:
+        way.ring = True
+    return ways
+
+def addMembers(relation, members, role):
+    for member in members:
+        member.addparent(relation)
+        relation.members.append((member, role))
+
 def parsePolygon(ogrgeometry):
     # Special case polygons with only one ring. This does not (or at least
     # should not) change behavior when simplify relations is turned on.
     if ogrgeometry.GetGeometryCount() == 0:
         l.warning("Polygon with no rings?")
     elif ogrgeometry.GetGeometryCount() == 1:
-        return parseLineString(ogrgeometry.GetGeometryRef(0))
+        exterior = parseRing(ogrgeometry.GetGeometryRef(0))
+        if len(exterior) == 1:
+            return exterior[0]
+        geometry = Relation()
+        geometry.multipolygon = True
+        addMembers(geometry, exterior, "outer")
+        return geometry
     else:
         geometry = Relation()
         try:
-            exterior = parseLineString(ogrgeometry.GetGeometryRef(0))
-            exterior.addparent(geometry)
+            exterior = parseRing(ogrgeometry.GetGeometryRef(0))
         except:
             l.warning("Polygon with no exterior ring?")
             return None
-        geometry.members.append((exterior, "outer"))
+        addMembers(geometry, exterior, "outer")
         for i in range(1, ogrgeometry.GetGeometryCount()):
-            interior = parseLineString(ogrgeometry.GetGeometryRef(i))
-            interior.addparent(geometry)
-            geometry.members.append((interior, "inner"))
+            interior = parseRing(ogrgeometry.GetGeometryRef(i))
+            addMembers(geometry, interior, "inner")
         return geometry
 
 def parseCollection(ogrgeometry):
@@ -421,20 +829,331 @@ def parseCollection(ogrgeometry):
         geometryType == ogr.wkbMultiPolygon25D):
         geometry = Relation()
         for polygon in range(ogrgeometry.GetGeometryCount()):
-            exterior = parseLineString(ogrgeometry.GetGeometryRef(polygon).GetGeometryRef(0))
-            exterior.addparent(geometry)
-            geometry.members.append((exterior, "outer"))
+            exterior = parseRing(ogrgeometry.GetGeometryRef(polygon).GetGeometryRef(0))
+            addMembers(geometry, exterior, "outer")
             for i in range(1, ogrgeometry.GetGeometryRef(polygon).GetGeometryCount()):
-                interior = parseLineString(ogrgeometry.GetGeometryRef(polygon).GetGeometryRef(i))
-                interior.addparent(geometry)
-                geometry.members.append((interior, "inner"))
+                interior = parseRing(ogrgeometry.GetGeometryRef(polygon).GetGeometryRef(i))
+                addMembers(geometry, interior, "inner")
     else:
         geometry = Relation()
         for i in range(ogrgeometry.GetGeometryCount()):
             member = parseGeometry(ogrgeometry.GetGeometryRef(i))
-            member.addparent(geometry)
-            geometry.members.append((member, "member"))
-        return geometry
+            if type(member) == list:
+                addMembers(geometry, member, "member")
+            else:
+                addMembers(geometry, [member], "member")
+    return geometry
+
+def getIDSequence():
+    # New elements get negative IDs counting down from -1, unless the user
+    # asked for positive IDs after an offset
+    if options.idOffset is None:
+        return iter(xrange(-1, -sys.maxint, -1))
+    else:
+        return iter(xrange(options.idOffset + 1, sys.maxint))
+
+def hilbertIndex(order, x, y):
+    # Distance of the cell (x, y) along a Hilbert curve filling a square
+    # of 2**order by 2**order cells
+    d = 0
+    s = 1 << (order - 1)
+    while s > 0:
+        rx = 1 if (x & s) else 0
+        ry = 1 if (y & s) else 0
+        d += s * s * ((3 * rx) ^ ry)
+        if ry == 0:
+            if rx == 1:
+                x = s - 1 - x
+                y = s - 1 - y
+            (x, y) = (y, x)
+        s >>= 1
+    return d
+
+def renumberIDs():
+    l.debug("Renumbering IDs")
+    global geometries
+    nodes = [geometry for geometry in geometries if type(geometry) == Point]
+    ways = [geometry for geometry in geometries if type(geometry) == Way]
+    relations = [geometry for geometry in geometries if type(geometry) == Relation]
+
+    # Nodes are ordered along a Hilbert curve laid over their bounding box,
+    # so that nodes close together in space get IDs close together
+    if nodes:
+        order = 16
+        cells = (1 << order) - 1
+        minx = min(node.x for node in nodes)
+        miny = min(node.y for node in nodes)
+        scalex = cells / ((max(node.x for node in nodes) - minx) or 1.0)
+        scaley = cells / ((max(node.y for node in nodes) - miny) or 1.0)
+        nodes.sort(key=lambda node: hilbertIndex(order,
+                                                 int((node.x - minx) * scalex),
+                                                 int((node.y - miny) * scaley)))
+    sequence = getIDSequence()
+    for node in nodes:
+        node.id = sequence.next()
+
+    # Ways follow the first node they reference. IDs are compared by
+    # magnitude, which is their position in the sequence either way.
+    ways.sort(key=lambda way: abs(way.points[0].id) if way.points else sys.maxint)
+    sequence = getIDSequence()
+    for way in ways:
+        way.id = sequence.next()
+
+    # Relations follow their first way (or node) member
+    def firstmember(relation):
+        for (member, role) in relation.members:
+            if type(member) != Relation:
+                return (type(member) != Way, abs(member.id))
+        return (True, sys.maxint)
+    relations.sort(key=firstmember)
+    sequence = getIDSequence()
+    for relation in relations:
+        relation.id = sequence.next()
+
+    # output() writes elements in the order of geometries
+    geometries = nodes + ways + relations
+
+def segmentDistance(point, start, end):
+    dx = end.x - start.x
+    dy = end.y - start.y
+    if dx == 0 and dy == 0:
+        return ((point.x - start.x) ** 2 + (point.y - start.y) ** 2) ** 0.5
+    t = ((point.x - start.x) * dx + (point.y - start.y) * dy) / (dx * dx + dy * dy)
+    t = max(0.0, min(1.0, t))
+    return ((point.x - start.x - t * dx) ** 2 + (point.y - start.y - t * dy) ** 2) ** 0.5
+
+def douglasPeucker(points, first, last, tolerance, keep):
+    # Marks the points between first and last that are needed to stay within
+    # tolerance of the original line. Uses a stack instead of recursion so
+    # very long ways don't hit the recursion limit.
+    stack = [(first, last)]
+    while stack:
+        (first, last) = stack.pop()
+        if last - first < 2:
+            continue
+        start = points[first]
+        end = points[last]
+        maxDistance = -1.0
+        for i in range(first + 1, last):
+            distance = segmentDistance(points[i], start, end)
+            if distance > maxDistance:
+                (index, maxDistance) = (i, distance)
+        if maxDistance > tolerance:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+
+def segmentsCross(a, b, c, d):
+    # True if segment ab crosses segment cd at a point inside both
+    def side(p, q, r):
+        return (q.x - p.x) * (r.y - p.y) - (q.y - p.y) * (r.x - p.x)
+    return (side(a, b, c) * side(a, b, d) < 0 and
+            side(c, d, a) * side(c, d, b) < 0)
+
+def restoreCrossings(ways, keeps):
+    # Simplifying each way on its own can make it cross itself, another way
+    # or another ring of the same polygon. Until no shortened segment crosses
+    # another segment, put back the vertex farthest from each one that does.
+    # Segments are found through a grid of cells about the size of an
+    # average segment.
+    restored = 0
+    while True:
+        segments = []
+        for w in range(len(ways)):
+            kept = [i for i in range(len(keeps[w])) if keeps[w][i]]
+            for (first, last) in zip(kept, kept[1:]):
+                segments.append((w, first, last))
+        if not segments:
+            return restored
+        size = 0.0
+        for (w, first, last) in segments:
+            (a, b) = (ways[w].points[first], ways[w].points[last])
+            size += max(abs(a.x - b.x), abs(a.y - b.y))
+        size = size / len(segments) or 1.0
+        grid = {}
+        for s in range(len(segments)):
+            (w, first, last) = segments[s]
+            (a, b) = (ways[w].points[first], ways[w].points[last])
+            for cx in range(int(min(a.x, b.x) // size), int(max(a.x, b.x) // size) + 1):
+                for cy in range(int(min(a.y, b.y) // size), int(max(a.y, b.y) // size) + 1):
+                    grid.setdefault((cx, cy), []).append(s)
+
+        crossing = set()
+        for cell in grid.values():
+            for i in range(len(cell)):
+                (w1, first1, last1) = segments[cell[i]]
+                for j in range(i + 1, len(cell)):
+                    (w2, first2, last2) = segments[cell[j]]
+                    # Crossings between original segments can't be helped
+                    if last1 - first1 < 2 and last2 - first2 < 2:
+                        continue
+                    (a, b) = (ways[w1].points[first1], ways[w1].points[last1])
+                    (c, d) = (ways[w2].points[first2], ways[w2].points[last2])
+                    if segmentsCross(a, b, c, d):
+                        crossing.add(cell[i])
+                        crossing.add(cell[j])
+        changed = False
+        for s in crossing:
+            (w, first, last) = segments[s]
+            if last - first < 2:
+                continue
+            points = ways[w].points
+            index = max(range(first + 1, last),
+                        key=lambda i: segmentDistance(points[i], points[first], points[last]))
+            keeps[w][index] = True
+            restored += 1
+            changed = True
+        if not changed:
+            return restored
+
+def simplifyWays():
+    l.debug("Simplifying ways")
+    global geometries
+    ways = [geometry for geometry in geometries if type(geometry) == Way]
+
+    # Count the ways using each location. Locations used by more than one
+    # way, or by a node that is not part of a way, are kept so that the ways
+    # still connect once points are merged.
+    usecount = {}
+    for way in ways:
+        for location in set((point.x, point.y) for point in way.points):
+            usecount[location] = usecount.get(location, 0) + 1
+    for geometry in geometries:
+        if (type(geometry) == Point and
+            [parent for parent in geometry.parents if type(parent) != Way]):
+            usecount[(geometry.x, geometry.y)] = 2
+
+    keeps = []
+    for way in ways:
+        points = way.points
+        keep = [usecount[(point.x, point.y)] > 1 for point in points]
+        if points:
+            keep[0] = keep[-1] = True
+        anchors = [i for i in range(len(points)) if keep[i]]
+        for (first, last) in zip(anchors, anchors[1:]):
+            douglasPeucker(points, first, last, options.simplifyTolerance, keep)
+        # Don't collapse closed rings
+        if (len(points) > 1 and
+            (points[0].x, points[0].y) == (points[-1].x, points[-1].y) and
+            keep.count(True) < 4):
+            keep = [True] * len(points)
+        keeps.append(keep)
+    restored = restoreCrossings(ways, keeps)
+    if restored:
+        l.debug("Restored %d vertices to avoid crossings" % restored)
+
+    removed = set()
+    total = 0
+    for (way, keep) in zip(ways, keeps):
+        points = way.points
+        total += len(points)
+        if False not in keep:
+            continue
+        way.points = [point for (point, kept) in zip(points, keep) if kept]
+        for (point, kept) in zip(points, keep):
+            if not kept:
+                point.removeparent(way, False)
+                if len(point.parents) == 0:
+                    removed.add(point)
+
+    if removed:
+        geometries = [geometry for geometry in geometries if geometry not in removed]
+    l.info("Simplification removed %d of %d way vertices" % (len(removed), total))
+
+def extractSharedBoundaries():
+    l.debug("Extracting shared boundaries")
+    global geometries
+    # Points are merged, so closed rings start and end with the same point.
+    # Only rings that are areas on their own or the outer and inner members
+    # of a multipolygon can be made of several ways. A polygon in a generic
+    # collection is a plain member and has to stay closed.
+    def boundaryring(geometry):
+        for parent in geometry.parents:
+            if type(parent) == Relation:
+                for (member, role) in parent.members:
+                    if member is geometry and role not in ("outer", "inner"):
+                        return False
+        return True
+    rings = [geometry for geometry in geometries
+             if type(geometry) == Way and geometry.ring and
+             len(geometry.points) >= 4 and geometry.points[0] is geometry.points[-1]
+             and boundaryring(geometry)]
+
+    # Find the rings using each edge, in either direction
+    edgeRings = {}
+    for ring in rings:
+        for (a, b) in zip(ring.points, ring.points[1:]):
+            edge = (min(a.id, b.id), max(a.id, b.id))
+            edgeRings.setdefault(edge, []).append(ring.id)
+
+    segments = {}
+    removed = set()
+    before = 0
+    for ring in rings:
+        points = ring.points[:-1]
+        count = len(points)
+        owners = []
+        for i in range(count):
+            (a, b) = (points[i], points[(i + 1) % count])
+            owners.append(sorted(edgeRings[(min(a.id, b.id), max(a.id, b.id))]))
+        # Cut the ring wherever the rings using its edges change
+        changes = [i for i in range(count) if owners[i] != owners[i - 1]]
+        if changes:
+            runs = [[points[i % count] for i in range(start, stop + 1)]
+                    for (start, stop) in zip(changes, changes[1:] + [changes[0] + count])]
+        elif len(owners[0]) > 1:
+            # The whole ring is shared, like an enclave filling another
+            # polygon's hole. Start it at its lowest node ID so that every
+            # ring using it finds the same way.
+            start = min(range(count), key=lambda i: points[i].id)
+            runs = [points[start:] + points[:start] + [points[start]]]
+        else:
+            # Rings that share nothing stay as they are
+            continue
+
+        # Each piece is looked up by its points in either direction, so the
+        # rings on both sides of a boundary end up with the same way
+        pieces = []
+        for piece in runs:
+            key = tuple(point.id for point in piece)
+            key = min(key, key[::-1])
+            if key not in segments:
+                way = Way()
+                way.points = piece
+                for point in piece:
+                    point.addparent(way)
+                segments[key] = way
+            pieces.append(segments[key])
+
+        for parent in list(ring.parents):
+            if type(parent) == Feature:
+                relation = Relation()
+                relation.multipolygon = True
+                addMembers(relation, pieces, "outer")
+                parent.geometry = relation
+                relation.addparent(parent)
+                setMultipolygonType(parent)
+            else:
+                members = []
+                for (member, role) in parent.members:
+                    if member is ring:
+                        for piece in pieces:
+                            piece.addparent(parent)
+                            members.append((piece, role))
+                    else:
+                        members.append((member, role))
+                parent.members = members
+            ring.removeparent(parent, False)
+        for point in ring.points:
+            point.removeparent(ring, False)
+        removed.add(ring)
+        before += len(ring.points)
+
+    if removed:
+        geometries = [geometry for geometry in geometries if geometry not in removed]
+    after = sum(len(way.points) for way in segments.values())
+    l.info("Replaced %d rings with %d shared boundary ways, saving %d way nodes"
+           % (len(removed), len(segments), before - after))
 
 def mergePoints():
     l.debug("Merging points")
@@ -452,55 +1171,538 @@ def mergePoints():
 
     # Use list to get rid of extras
     l.debug("Checking list")
+    progress = Progress("merge", len(pointcoords), "locations")
     for (location, pointsatloc) in pointcoords.items():
+        progress.tick()
         if len(pointsatloc) > 1:
             for point in pointsatloc[1:]:
                 for parent in set(point.parents):
                     parent.replacejwithi(pointsatloc[0], point)
+    progress.finish()
         
+def writeNode(w, id, x, y, tags):
+    w.start("node", visible="true", id=str(id), lat=str(y), lon=str(x))
+    for (key, value) in tags.items():
+        w.element("tag", k=key, v=value)
+    w.end("node")
+
+def writeWay(w, id, refs, tags):
+    w.start("way", visible="true", id=str(id))
+    for ref in refs:
+        w.element("nd", ref=str(ref))
+    for (key, value) in tags.items():
+        w.element("tag", k=key, v=value)
+    w.end("way")
+
+def writeRelation(w, id, members, tags):
+    w.start("relation", visible="true", id=str(id))
+    for (ref, role) in members:
+        w.element("member", type="way", ref=str(ref), role=role)
+    for (key, value) in tags.items():
+        w.element("tag", k=key, v=value)
+    w.end("relation")
+
+def outputChunk(w, start, stop):
+    global outputElements, featuresmap
+    for element in outputElements[start:stop]:
+        if element in featuresmap:
+            tags = featuresmap[element].tags
+        else:
+            tags = {}
+        if type(element) == Point:
+            writeNode(w, element.id, element.x, element.y, tags)
+        elif type(element) == Way:
+            writeWay(w, element.id, [node.id for node in element.points], tags)
+        else:
+            writeRelation(w, element.id,
+                          [(member.id, role) for (member, role) in element.members],
+                          tags)
+
+def renderChunk((start, stop)):
+    # Runs in a worker process, which inherits the element lists from the
+    # parent when it is forked
+    import tempfile
+    (fd, chunkFile) = tempfile.mkstemp(suffix=".osm",
+                                       dir=os.path.dirname(options.outputFile))
+    f = os.fdopen(fd, 'w')
+    outputChunk(XMLWriter(f), start, stop)
+    f.close()
+    return chunkFile
+
 def output():
     l.debug("Outputting XML")
     # First, set up a few data structures for optimization purposes
-    global geometries, features
+    global geometries, features, outputElements, featuresmap
     nodes = [geometry for geometry in geometries if type(geometry) == Point]
     ways = [geometry for geometry in geometries if type(geometry) == Way]
     relations = [geometry for geometry in geometries if type(geometry) == Relation]
     featuresmap = {feature.geometry : feature for feature in features}
+    outputElements = nodes + ways + relations
+
+    # Every element is written completely within a chunk, so chunks can be
+    # rendered independently and concatenated in order
+    chunks = [(start, min(start + OUTPUT_CHUNK_SIZE, len(outputElements)))
+              for start in range(0, len(outputElements), OUTPUT_CHUNK_SIZE)]
+
+    done = 0
+    if checkpoint["stage"] == "output" and os.path.exists(options.outputFile):
+        # Drop anything written after the last complete chunk
+        done = checkpoint["chunks"]
+        l.info("Resuming output after %d of %d chunks" % (done, len(chunks)))
+        f = open(options.outputFile, 'r+')
+        f.seek(checkpoint["offset"])
+        f.truncate()
+    else:
+        f = open(options.outputFile, 'w')
+        f.write(OSM_HEADER)
+    if done:
+        remaining = len(outputElements) - chunks[done - 1][1]
+    else:
+        remaining = len(outputElements)
+    progress = Progress("output", remaining, "elements")
+    if options.jobs > 1 and len(chunks) - done > 1:
+        l.debug("Rendering %d chunks with %d processes" % (len(chunks) - done, options.jobs))
+        import multiprocessing
+        import shutil
+        pool = multiprocessing.Pool(options.jobs)
+        for chunkFile in pool.imap(renderChunk, chunks[done:]):
+            chunk = open(chunkFile, 'r')
+            shutil.copyfileobj(chunk, f, 1024 * 1024)
+            chunk.close()
+            os.remove(chunkFile)
+            progress.tick(chunks[done][1] - chunks[done][0])
+            done += 1
+            checkpointOutput(f, done)
+        pool.close()
+        pool.join()
+    else:
+        w = XMLWriter(f)
+        for (start, stop) in chunks[done:]:
+            outputChunk(w, start, stop)
+            progress.tick(stop - start)
+            done += 1
+            checkpointOutput(f, done)
+    progress.finish()
+    f.write(OSM_FOOTER)
+    f.close()
+
+def partitionFeatures():
+    # Groups the features into the parts given by --split-by, keyed by the
+    # name used for the part in its filename
+    (kind, value) = options.splitBy
+    groups = OrderedDict()
+    for i in range(len(features)):
+        feature = features[i]
+        if kind == "layer":
+            key = feature.layer
+        elif kind == "attribute":
+            key = feature.tags.get(value)
+        else:
+            key = str(i // value)
+        groups.setdefault(key, []).append(feature)
+
+    # Different values can clean up to the same name, so later ones get a
+    # numbered suffix rather than sharing a part
+    parts = OrderedDict()
+    for (key, groupFeatures) in groups.items():
+        name = re.sub(r"[^\w.-]+", "_", key or "none")
+        if name in parts:
+            suffix = 2
+            while "%s-%d" % (name, suffix) in parts:
+                suffix += 1
+            name = "%s-%d" % (name, suffix)
+        parts[name] = groupFeatures
+    return parts
+
+def writePart(part):
+    # May run in a worker process, which inherits the parts from the parent
+    # when it is forked
+    global outputElements
+    outputElements = partElements[part]
+    f = open(partFiles[part], 'w')
+    f.write(OSM_HEADER)
+    outputChunk(XMLWriter(f), 0, len(outputElements))
+    f.write(OSM_FOOTER)
+    f.close()
+
+    summary = {"file": os.path.basename(partFiles[part])}
+    for (name, kind) in (("nodes", Point), ("ways", Way), ("relations", Relation)):
+        ids = [element.id for element in outputElements if type(element) == kind]
+        summary[name] = {"count": len(ids),
+                         "minId": min(ids) if ids else None,
+                         "maxId": max(ids) if ids else None}
+    return summary
+
+def outputParts():
+    l.debug("Outputting split XML")
+    global geometries, features, featuresmap, partElements, partFiles
+    featuresmap = {feature.geometry : feature for feature in features}
+    parts = partitionFeatures()
+
+    # Index the parts each geometry belongs to by walking down from the
+    # features of each part once. A node on the border between parts
+    # belongs to all of them, so every part is self-contained.
+    index = {}
+    for (part, key) in enumerate(parts):
+        for feature in parts[key]:
+            stack = [feature.geometry]
+            while stack:
+                geometry = stack.pop()
+                owners = index.setdefault(geometry, set())
+                if part in owners:
+                    continue
+                owners.add(part)
+                if type(geometry) == Way:
+                    stack.extend(geometry.points)
+                elif type(geometry) == Relation:
+                    stack.extend(member for (member, role) in geometry.members)
+
+    # Geometries without a feature go in the first part
+    partElements = [[] for key in parts]
+    for geometry in geometries:
+        for part in index.get(geometry, (0,)):
+            partElements[part].append(geometry)
+    order = {Point: 0, Way: 1, Relation: 2}
+    for elements in partElements:
+        elements.sort(key=lambda element: order[type(element)])
+
+    (base, ext) = os.path.splitext(options.outputFile)
+    partFiles = [base + "-" + key + ext for key in parts]
+    manifestFile = base + ".manifest.json"
+    # Parts found when resuming in the parts stage were written by the
+    # interrupted conversion
+    if not options.forceOverwrite and checkpoint["stage"] != "parts":
+        for filename in partFiles + [manifestFile]:
+            if os.path.exists(filename):
+                l.error("output file '%s' exists" % (filename))
+                sys.exit(1)
+    if options.checkpointDir:
+        writeCheckpoint("parts")
+
+    if options.jobs > 1 and len(parts) > 1:
+        l.debug("Writing %d parts with %d processes" % (len(parts), options.jobs))
+        import multiprocessing
+        pool = multiprocessing.Pool(options.jobs)
+        summaries = pool.map(writePart, range(len(parts)))
+        pool.close()
+        pool.join()
+    else:
+        summaries = [writePart(part) for part in range(len(parts))]
 
-    w = XMLWriter(open(options.outputFile, 'w'))
-    w.start("osm", version='0.6', generator='uvmogr2osm')
+    import json
+    f = open(manifestFile, 'w')
+    json.dump({"parts": summaries}, f, indent=2, sort_keys=True)
+    f.close()
+    l.info("Wrote %d parts, listed in '%s'" % (len(parts), manifestFile))
 
-    for node in nodes:
-        w.start("node", visible="true", id=str(node.id), lat=str(node.y), lon=str(node.x))
-        if node in featuresmap:
-            for (key, value) in featuresmap[node].tags.items():
-                w.element("tag", k=key, v=value)
-        w.end("node")
 
-    for way in ways:
-        w.start("way", visible="true", id=str(way.id))
-        for node in way.points:
-            w.element("nd", ref=str(node.id))
-        if way in featuresmap:
-            for (key, value) in featuresmap[way].tags.items():
-                w.element("tag", k=key, v=value)
-        w.end("way")
+def writeSection(filename, records):
+    f = open(filename, 'wb')
+    for start in range(0, len(records), RUN_CHUNK_SIZE):
+        marshal.dump(records[start:start + RUN_CHUNK_SIZE], f)
+    f.close()
 
-    for relation in relations:
-        w.start("relation", visible="true", id=str(relation.id))
-        for (member, role) in relation.members:
-            w.element("member", type="way", ref=str(member.id), role=role)
-        if relation in featuresmap:
-            for (key, value) in featuresmap[relation].tags.items():
-                w.element("tag", k=key, v=value)
-        w.end("relation")
-
-    w.end("osm")
+def readSection(filename):
+    f = open(filename, 'rb')
+    while True:
+        try:
+            chunk = marshal.load(f)
+        except EOFError:
+            break
+        for record in chunk:
+            yield record
+    f.close()
+
+def writeRun(filename, geometries, features, sortNodes=False):
+    # Stores the geometries with their features in three files, one per
+    # element type. Ways and relations refer to their members by position
+    # within the run. Tags are stored as lists of items to keep their order.
+    # A fourth file lists the features in the order they were created, which
+    # the order of the element files would lose.
+    nodes = [geometry for geometry in geometries if type(geometry) == Point]
+    ways = [geometry for geometry in geometries if type(geometry) == Way]
+    relations = [geometry for geometry in geometries if type(geometry) == Relation]
+    featuresmap = {feature.geometry : (feature.tags.items(), feature.layer)
+                   for feature in features}
+    if sortNodes:
+        nodes.sort(key=lambda node: (node.x, node.y))
+    index = {}
+    for elements in (nodes, ways, relations):
+        for i in range(len(elements)):
+            index[elements[i]] = i
+    kinds = {Point: "n", Way: "w", Relation: "r"}
+
+    writeSection(filename + ".nodes",
+                 [(node.id, node.x, node.y, featuresmap.get(node))
+                  for node in nodes])
+    writeSection(filename + ".ways",
+                 [(way.id, [index[node] for node in way.points],
+                   featuresmap.get(way), way.ring)
+                  for way in ways])
+    writeSection(filename + ".relations",
+                 [(relation.id,
+                   [(kinds[type(member)], index[member], role)
+                    for (member, role) in relation.members],
+                   featuresmap.get(relation))
+                  for relation in relations])
+    writeSection(filename + ".features",
+                 [(kinds[type(feature.geometry)], index[feature.geometry],
+                   feature.tags.items(), feature.layer)
+                  for feature in features if feature.geometry in index])
+    return (len(nodes), len(ways), len(relations))
+
+def spillRun():
+    global geometries, features, spillDirectory
+    if spillDirectory is None:
+        import tempfile
+        spillDirectory = tempfile.mkdtemp(prefix="ogr2osm-",
+                                          dir=os.path.dirname(options.outputFile))
+        l.info("Memory limit reached, spilling parsed data to '%s'" % spillDirectory)
+        if options.simplifyTolerance is not None:
+            l.warning("Simplifying each spilled run separately, ways in " +
+                      "different runs may lose their shared vertices")
+    if options.simplifyTolerance is not None:
+        simplifyWays()
+    runFile = os.path.join(spillDirectory, "run%d" % len(spillRuns))
+    l.debug("Spilling %d geometries to '%s'" % (len(geometries), runFile))
+    counts = writeRun(runFile, geometries, features, sortNodes=True)
+    spillRuns.append((runFile,) + counts)
+    geometries = []
+    features = []
+
+def featureTags(feature):
+    if feature is None:
+        return OrderedDict()
+    return OrderedDict(feature[0])
+
+def readSortedNodes(run, runFile):
+    for (id, x, y, feature) in readSection(runFile + ".nodes"):
+        yield (x, y, run, featureTags(feature))
+
+def outputRuns():
+    # External-memory version of mergePoints() and output(). The nodes of
+    # each run are sorted by location, so merging the runs brings all the
+    # nodes at a location together and each location is written once.
+    l.debug("Merging and outputting spilled data")
+    f = open(options.outputFile, 'w')
+    f.write(OSM_HEADER)
+    w = XMLWriter(f)
+
+    nodeIds = [array('l', [0]) * nodeCount
+               for (runFile, nodeCount, wayCount, relationCount) in spillRuns]
+    positions = [0] * len(spillRuns)
+    sequence = getIDSequence()
+    node = None
+    streams = [readSortedNodes(run, spillRuns[run][0])
+               for run in range(len(spillRuns))]
+    progress = Progress("merge and output nodes",
+                        sum(run[1] for run in spillRuns), "nodes")
+    for (x, y, run, tags) in heapq.merge(*streams):
+        progress.tick()
+        if node is None or (x, y) != (node[1], node[2]):
+            if node is not None:
+                writeNode(w, *node)
+            node = [sequence.next(), x, y, {}]
+        if tags and not node[3]:
+            node[3] = tags
+        nodeIds[run][positions[run]] = node[0]
+        positions[run] += 1
+    if node is not None:
+        writeNode(w, *node)
+    progress.finish()
+
+    # Ways are not merged, so they are written run by run
+    wayIds = []
+    sequence = getIDSequence()
+    progress = Progress("output ways", sum(run[2] for run in spillRuns), "ways")
+    for run in range(len(spillRuns)):
+        wayIds.append(array('l'))
+        for (unused, refs, feature, ring) in readSection(spillRuns[run][0] + ".ways"):
+            id = sequence.next()
+            wayIds[run].append(id)
+            writeWay(w, id, [nodeIds[run][ref] for ref in refs],
+                     featureTags(feature))
+            progress.tick()
+    progress.finish()
+
+    # Relations may refer to relations later in their run, so number them
+    # all before writing
+    relationIds = []
+    sequence = getIDSequence()
+    for (runFile, nodeCount, wayCount, relationCount) in spillRuns:
+        relationIds.append(array('l', [sequence.next() for i in xrange(relationCount)]))
+    for run in range(len(spillRuns)):
+        memberIds = {"n": nodeIds[run], "w": wayIds[run], "r": relationIds[run]}
+        position = 0
+        for (unused, members, feature) in readSection(spillRuns[run][0] + ".relations"):
+            writeRelation(w, relationIds[run][position],
+                          [(memberIds[kind][ref], role) for (kind, ref, role) in members],
+                          featureTags(feature))
+            position += 1
+
+    f.write(OSM_FOOTER)
+    f.close()
+
+def loadRun(filename, idShift=0):
+    # Recreates geometries and features stored by writeRun, keeping their
+    # IDs, optionally shifted by idShift
+    nodes = []
+    for (id, x, y, feature) in readSection(filename + ".nodes"):
+        node = Point(x, y)
+        node.id = id + idShift
+        nodes.append(node)
+    ways = []
+    for (id, refs, feature, ring) in readSection(filename + ".ways"):
+        way = Way()
+        way.id = id + idShift
+        way.ring = ring
+        for ref in refs:
+            way.points.append(nodes[ref])
+            nodes[ref].addparent(way)
+        ways.append(way)
+    # Relations can have later relations as members, so create them all
+    # before filling in the members
+    records = list(readSection(filename + ".relations"))
+    relations = []
+    for (id, members, feature) in records:
+        relation = Relation()
+        relation.id = id + idShift
+        relations.append(relation)
+    elements = {"n": nodes, "w": ways, "r": relations}
+    for (relation, (id, members, feature)) in zip(relations, records):
+        for (kind, ref, role) in members:
+            member = elements[kind][ref]
+            member.addparent(relation)
+            relation.members.append((member, role))
+
+    # Features are created in their original order, which --split-by and
+    # the choice between features of the same geometry depend on
+    for (kind, ref, tags, layer) in readSection(filename + ".features"):
+        feature = Feature()
+        feature.tags = OrderedDict(tags)
+        feature.layer = layer
+        feature.geometry = elements[kind][ref]
+        feature.geometry.addparent(feature)
+
+def removeRun(filename):
+    for section in (".nodes", ".ways", ".relations", ".features"):
+        os.remove(filename + section)
+
+def checkpointSignature():
+    # Options that don't change the result may differ when resuming
+    ignored = ("resume", "forceOverwrite", "checkpointDir", "jobs",
+               "verbose", "debugTags", "progress", "statusFile")
+    return repr(sorted((key, value) for (key, value) in vars(options).items()
+                       if key not in ignored))
+
+def sourceStamps():
+    # Editing a source changes its size or modification time
+    return [(sourceFile, os.path.getsize(sourceFile), os.path.getmtime(sourceFile))
+            for sourceFile in sourceFiles]
+
+def readCheckpoint():
+    state = {"stage": "parse", "layers": 0}
+    if options.checkpointDir and not os.path.isdir(options.checkpointDir):
+        os.makedirs(options.checkpointDir)
+    if not options.resume:
+        return state
+    stateFile = os.path.join(options.checkpointDir, "state")
+    if not os.path.exists(stateFile):
+        l.info("No checkpoint found in '%s', starting from the beginning"
+               % options.checkpointDir)
+    else:
+        f = open(stateFile, 'rb')
+        state = marshal.load(f)
+        f.close()
+        if (state["sources"] != sourceStamps() or
+            state["signature"] != checkpointSignature()):
+            l.error(("The checkpoint in '%s' is for different or changed " +
+                     "source files, or different options") % options.checkpointDir)
+            sys.exit(1)
+        l.info("Resuming from checkpoint at stage '%s'" % state["stage"])
+        if [hook for hook in userHooks if hook != "filterTags"]:
+            l.warning("State kept by the translation in earlier runs is lost " +
+                      "when resuming")
+
+    # Only a checkpoint in the output stage continues an existing output
+    # file, anything else would overwrite it
+    if (state["stage"] != "output" and not options.forceOverwrite and
+        not options.splitBy and os.path.exists(options.outputFile)):
+        parser.error("ERROR: output file '%s' exists" % (options.outputFile))
+    return state
+
+def writeCheckpoint(stage, **values):
+    # The state is replaced atomically, after everything it refers to has
+    # been written
+    checkpoint.update(values)
+    checkpoint["stage"] = stage
+    checkpoint["sources"] = sourceStamps()
+    checkpoint["signature"] = checkpointSignature()
+    checkpoint["idCounter"] = elementIdCounter
+    stateFile = os.path.join(options.checkpointDir, "state")
+    f = open(stateFile + ".tmp", 'wb')
+    marshal.dump(checkpoint, f)
+    f.flush()
+    os.fsync(f.fileno())
+    f.close()
+    os.rename(stateFile + ".tmp", stateFile)
+
+def checkpointOutput(f, chunks):
+    if options.checkpointDir:
+        f.flush()
+        os.fsync(f.fileno())
+        writeCheckpoint("output", chunks=chunks, offset=f.tell())
+
+def removeCheckpoint():
+    for filename in os.listdir(options.checkpointDir):
+        if (filename.startswith("layer") or filename.startswith("merged") or
+            filename.startswith("state")):
+            os.remove(os.path.join(options.checkpointDir, filename))
+    try:
+        os.rmdir(options.checkpointDir)
+    except OSError:
+        pass
 
 
 # Main flow
-data = getFileData(sourceFile)
-parseData(data)
-mergePoints()
-translations.preOutputTransform(geometries, features)
-output()
+checkpoint = readCheckpoint()
+if checkpoint["stage"] == "parse":
+    parseSources(sourceFiles)
+if spillRuns:
+    spillRun()
+    if "preOutputTransform" in userHooks:
+        l.warning("preOutputTransform is not called when parsed data is " +
+                  "spilled to disk")
+    if options.sortIds:
+        l.warning("Nodes are numbered in coordinate order rather than " +
+                  "along a Hilbert curve when parsed data is spilled to disk")
+    if options.sharedBoundaries:
+        l.warning("Shared boundaries are not extracted when parsed data " +
+                  "is spilled to disk")
+    outputRuns()
+    import shutil
+    shutil.rmtree(spillDirectory)
+else:
+    if checkpoint["stage"] == "parse":
+        if options.simplifyTolerance is not None:
+            simplifyWays()
+        mergePoints()
+        if options.sharedBoundaries:
+            extractSharedBoundaries()
+        translations.preOutputTransform(geometries, features)
+        if options.sortIds:
+            renumberIDs()
+        if options.checkpointDir:
+            writeRun(os.path.join(options.checkpointDir, "merged"),
+                     geometries, features)
+            writeCheckpoint("merged")
+    else:
+        l.info("Loading merged data from checkpoint")
+        loadRun(os.path.join(options.checkpointDir, "merged"))
+        elementIdCounter = checkpoint["idCounter"]
+    if options.splitBy:
+        outputParts()
+    else:
+        output()
+    if options.checkpointDir:
+        removeCheckpoint()